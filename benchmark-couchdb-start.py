@@ -25,20 +25,39 @@
 Benchmark time it takes CouchDB to start.
 """
 
+import argparse
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from usercouch.misc import TempCouch
 
 
-count = 10
-times = []
-for i in range(count):
+def one_run():
     tmp = TempCouch()
     start = time.monotonic()
     tmp.bootstrap()
     elapsed = time.monotonic() - start
-    times.append(elapsed)
-    
+    tmp.kill()
+    return elapsed
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--count', type=int, default=10,
+    help='number of CouchDB instances to start (default: 10)'
+)
+parser.add_argument('--serial', action='store_true',
+    help='start one CouchDB at a time instead of all at once'
+)
+args = parser.parse_args()
+
+count = args.count
+if args.serial:
+    times = [one_run() for i in range(count)]
+else:
+    with ThreadPoolExecutor(max_workers=count) as executor:
+        futures = [executor.submit(one_run) for i in range(count)]
+        times = [f.result() for f in futures]
+
 print('')
 print('Average: {:.3f}'.format(sum(times) / count))
 print('Max: {:.3f}'.format(max(times)))
@@ -26,8 +26,8 @@ Install `usercouch`.
 """
 
 import sys
-if sys.version_info < (3, 4):
-    sys.exit('ERROR: UserCouch requires Python 3.4 or newer')
+if sys.version_info < (3, 5):
+    sys.exit('ERROR: UserCouch requires Python 3.5 or newer')
 
 import os
 from os import path
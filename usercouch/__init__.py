@@ -28,14 +28,14 @@ import os
 from os import path
 import stat
 import fcntl
+import select
 import time
-from copy import deepcopy
 from subprocess import Popen
 from hashlib import sha1, pbkdf2_hmac
-import binascii
 from base64 import b64encode
 import json
 from collections import namedtuple
+from functools import lru_cache
 
 from dbase32 import random_id
 from degu.client import Client
@@ -43,6 +43,16 @@ from degu.client import Client
 
 __version__ = '17.11.0'
 
+# We give CouchDB ~17 seconds to start, probing first after 10 milliseconds,
+# then backing off to at most every 100 milliseconds:
+START_TIMEOUT = 17
+PROBE_INTERVAL = 0.01
+MAX_PROBE_INTERVAL = 0.1
+
+# Socket timeout for requests to CouchDB, so a hung connection can't stall
+# start() or check() for degu's default 65 seconds:
+REQUEST_TIMEOUT = 10
+
 
 def _check_for_couchdb2(rootdir):
     couch2 = path.join(rootdir, 'opt', 'couchdb', 'releases', 'RELEASES')
@@ -93,6 +103,7 @@ FILE_COMPRESSION = (
     'deflate_9',
     'snappy',
 )
+_FILE_COMPRESSION_SET = frozenset(FILE_COMPRESSION)
 
 # Minimum SSL config that must be provided in overrides['ssl']:
 REQUIRED_SSL_CONFIG = ('cert_file', 'key_file')
@@ -177,6 +188,10 @@ VERSION_TEMPLATE = {
 }
 
 
+# Auth modes that create an admin user (and so need username, password, salt):
+AUTH_WITH_ADMIN = frozenset(['basic', 'oauth'])
+
+
 def check_auth(version, auth):
     templates = VERSION_TEMPLATE[version]
     value = templates.get(auth)
@@ -274,25 +289,45 @@ VM_ARGS = """
 ########################################################################
 # Functions for building CouchDB session.ini file, Microfiber-style env:
 
+def random_ids(count):
+    """
+    Return a list of *count* random 120-bit Dbase32 IDs.
+
+    Each ID is like one from `dbase32.random_id()`, but they all come from a
+    single `os.urandom()` draw and a single encode:
+
+    >>> [len(_id) for _id in random_ids(3)]
+    [24, 24, 24]
+
+    This works because 15 bytes encode to exactly 24 Dbase32 characters.  As
+    `dbase32.random_id()` draws at most 60 bytes, *count* must be 1 to 4.
+    """
+    ids = random_id(15 * count)
+    return [ids[i:i + 24] for i in range(0, 24 * count, 24)]
+
+
 def random_oauth():
     """
     Return a `dict` containing random OAuth 1a tokens.
     """
-    return dict(
-        (k, random_id())
-        for k in ('consumer_key', 'consumer_secret', 'token', 'token_secret')
-    )
+    (consumer_key, consumer_secret, token, token_secret) = random_ids(4)
+    return {
+        'consumer_key': consumer_key,
+        'consumer_secret': consumer_secret,
+        'token': token,
+        'token_secret': token_secret,
+    }
 
 
 def tohex(data):
-    return binascii.hexlify(data).decode()
+    return data.hex()
 
 
 def random_salt():
     """
     Return a 128-bit hex-encoded random salt for use  by `couch_hashed()`.
     """
-    return tohex(os.urandom(16))
+    return os.urandom(16).hex()
 
 
 def couch_hashed(password, salt):
@@ -338,7 +373,7 @@ def couch_pbkdf2(password, salt, rounds=10):
     assert isinstance(password, str)
     assert isinstance(salt, str)
     digest = pbkdf2_hmac('sha1', password.encode(), salt.encode(), rounds)
-    return '-pbkdf2-{},{},{}'.format(tohex(digest), salt, rounds)
+    return '-pbkdf2-{},{},{}'.format(digest.hex(), salt, rounds)
 
 
 def check_ssl_config(ssl_config):
@@ -410,7 +445,7 @@ def build_config(auth, overrides=None):
         config.update(overrides)
     if 'uuid' not in config:
         config['uuid'] = random_salt()
-    if config['file_compression'] not in FILE_COMPRESSION:
+    if config['file_compression'] not in _FILE_COMPRESSION_SET:
         raise ValueError("invalid config['file_compression']: {!r}".format(
                 config['file_compression'])
         )
@@ -418,10 +453,12 @@ def build_config(auth, overrides=None):
         check_ssl_config(config['ssl'])
     if 'replicator' in config:
         check_replicator_config(config['replicator'])
-    if auth in ('basic', 'oauth'):
-        if 'username' not in config:
+    if auth in AUTH_WITH_ADMIN:
+        if 'username' not in config and 'password' not in config:
+            (config['username'], config['password']) = random_ids(2)
+        elif 'username' not in config:
             config['username'] = random_id()
-        if 'password' not in config:
+        elif 'password' not in config:
             config['password'] = random_id()
         if 'salt' not in config:
             config['salt'] = random_salt()
@@ -483,9 +520,8 @@ def build_url(scheme, bind_address, port):
 
 
 def _basic_authorization(basic):
-    b = '{username}:{password}'.format(**basic).encode()
-    b64 = b64encode(b).decode()
-    return 'Basic ' + b64
+    b = (basic['username'] + ':' + basic['password']).encode()
+    return 'Basic ' + b64encode(b).decode('ascii')
 
 
 def build_env(auth, config, ports):
@@ -499,7 +535,7 @@ def build_env(auth, config, ports):
     }
     if 'chttpd_port' in ports:
         env['chttpd_address'] = (bind_address, ports['chttpd_port'])
-    if auth in ('basic', 'oauth'):
+    if auth in AUTH_WITH_ADMIN:
         env['basic'] = {
             'username': config['username'],
             'password': config['password'],
@@ -509,7 +545,11 @@ def build_env(auth, config, ports):
         env['oauth'] = config['oauth']
     if 'ssl_port' in ports:
         ssl_port = ports['ssl_port']
-        env2 = deepcopy(env)
+        env2 = dict(env)
+        if 'basic' in env:
+            env2['basic'] = dict(env['basic'])
+        if 'oauth' in env:
+            env2['oauth'] = dict(env['oauth'])
         env2['port'] = ssl_port
         env2['url'] = build_url('https', bind_address, ssl_port)
         env['x_env_ssl'] = env2
@@ -535,7 +575,7 @@ def build_template_kw(auth, config, ports, paths):
                 kw[key] = ssl_cfg[key]
     if 'replicator' in config:
         kw['replicator'] = config['replicator']
-    if auth in ('basic', 'oauth'):
+    if auth in AUTH_WITH_ADMIN:
         kw['username'] = config['username']
         kw['hashed'] = couch_pbkdf2(config['password'], config['salt'])
     if auth == 'oauth':
@@ -543,23 +583,50 @@ def build_template_kw(auth, config, ports, paths):
     return kw
 
 
-def build_session_ini(version, auth, kw):
+@lru_cache(maxsize=None)
+def _get_session_template(version, auth, ssl, replicator):
     template = get_template(version, auth)
-    if 'ssl_port' in kw:
+    if ssl:
         template += SSL
+    if replicator is not None:
+        template += replicator
+    return template
+
+
+def build_session_ini(version, auth, kw):
+    replicator = None
     if 'replicator' in kw:
         if 'cert_file' in kw['replicator']:
-            template += REPLICATOR_EXTRA
+            replicator = REPLICATOR_EXTRA
         else:
-            template += REPLICATOR
-    return template.format(**kw)
+            replicator = REPLICATOR
+    template = _get_session_template(version, auth, 'ssl_port' in kw, replicator)
+    return template.format_map(kw)
 
 
 def build_vm_args(kw):
     return VM_ARGS.format(**kw)
 
 
-def bind_socket(bind_address):
+def address_family(bind_address):
+    """
+    Return the socket address family appropriate for *bind_address*.
+
+    For example:
+
+    >>> address_family('127.0.0.1') == socket.AF_INET
+    True
+    >>> address_family('::1') == socket.AF_INET6
+    True
+    """
+    if bind_address in ('127.0.0.1', '0.0.0.0'):
+        return socket.AF_INET
+    if bind_address in ('::1', '::'):
+        return socket.AF_INET6
+    raise ValueError('invalid bind_address: {!r}'.format(bind_address))
+
+
+def bind_socket(bind_address, family=None):
     """
     Bind a socket to *bind_address* and a random port.
 
@@ -575,26 +642,49 @@ def bind_socket(bind_address):
 
     The random port will be chosen by the operating system based on currently
     available ports.
+
+    If already known, the *family* from `address_family()` can be provided to
+    skip checking *bind_address* again.
     """
-    if bind_address in ('127.0.0.1', '0.0.0.0'):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    elif bind_address in ('::1', '::'):
-        sock = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
-    else:
-        raise ValueError('invalid bind_address: {!r}'.format(bind_address))
+    if family is None:
+        family = address_family(bind_address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
     sock.bind((bind_address, 0))
     return sock
 
 
+def probe_address(address, timeout=PROBE_INTERVAL):
+    """
+    Return `True` if a TCP connection can be made to *address*.
+
+    For example, nothing is listening on a socket that is merely bound:
+
+    >>> sock = bind_socket('127.0.0.1')
+    >>> probe_address(sock.getsockname())
+    False
+
+    This is a cheap readiness check used by `UserCouch.start()` before it makes
+    a full HTTP request.  The address family comes straight from
+    `address_family()`, so no name resolution is done.
+    """
+    sock = socket.socket(address_family(address[0]), socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        return sock.connect_ex(address) == 0
+    finally:
+        sock.close()
+
+
 class Sockets:
     """
     Helper class to make it easy to deal with one or more random ports.
     """
 
-    __slots__ = ('bind_address', 'socks')
+    __slots__ = ('bind_address', 'family', 'socks')
 
     def __init__(self, bind_address):
         self.bind_address = bind_address
+        self.family = address_family(bind_address)
         self.socks = {}
         self.add_port('port')
         if couch_version.couchdb2:
@@ -603,7 +693,7 @@ class Sockets:
     def add_port(self, name):
         assert isinstance(name, str)
         assert name not in self.socks
-        self.socks[name] = bind_socket(self.bind_address)
+        self.socks[name] = bind_socket(self.bind_address, self.family)
 
     def add_ssl(self):
         self.add_port('ssl_port')
@@ -619,14 +709,17 @@ class Sockets:
             sock.close()
 
 
+# The part of the CouchDB 1.x command line that doesn't change per session:
+COUCHDB_CMD = (
+    '/usr/bin/couchdb',
+    '-n',  # reset configuration file chain (including system default)
+    '-a', '/etc/couchdb/default.ini',
+    '-a', USERCOUCH_INI,
+)
+
+
 def get_cmd(session_ini):
-    return [
-        '/usr/bin/couchdb',
-        '-n',  # reset configuration file chain (including system default)
-        '-a', '/etc/couchdb/default.ini',
-        '-a', USERCOUCH_INI,
-        '-a', session_ini,
-    ]
+    return list(COUCHDB_CMD + ('-a', session_ini))
 
 
 def read_start_data(prefix='/opt/couchdb'):
@@ -662,8 +755,7 @@ def build_command(paths, sd, environ):
 def start_couchdb(paths, prefix='/opt/couchdb'):
     if couch_version.couchdb2:
         sd = read_start_data(prefix)
-        environ = dict(os.environ)
-        environ.update(build_environ(sd, prefix))
+        environ = dict(os.environ, **build_environ(sd, prefix))
         command = build_command(paths, sd, environ)
     else:
         command = get_cmd(paths.ini)
@@ -671,6 +763,33 @@ def start_couchdb(paths, prefix='/opt/couchdb'):
     return Popen(command, env=environ)
 
 
+def wait_for_exit(proc, timeout):
+    """
+    Wait up to *timeout* seconds for the `Popen` *proc* to exit.
+
+    Returns `True` if the process has exited, `False` otherwise.
+
+    Where `os.pidfd_open()` is available, this blocks on the process file
+    descriptor so an early exit is noticed immediately; otherwise it simply
+    sleeps for *timeout* seconds.
+    """
+    if proc.returncode is not None:
+        return True
+    try:
+        fd = os.pidfd_open(proc.pid)
+    except (AttributeError, OSError):
+        time.sleep(timeout)
+    else:
+        try:
+            # poll() rather than select(), which can't handle fd >= FD_SETSIZE:
+            poller = select.poll()
+            poller.register(fd, select.POLLIN)
+            poller.poll(timeout * 1000)
+        finally:
+            os.close(fd)
+    return proc.poll() is not None
+
+
 #######################
 # Path related helpers:
 
@@ -678,45 +797,98 @@ def mkdir(basedir, name):
     dirname = path.join(basedir, name)
     try:
         os.mkdir(dirname)
-    except OSError:
+    except FileExistsError:
         mode = os.lstat(dirname).st_mode
         if not stat.S_ISDIR(mode):
             raise ValueError('not a directory: {!r}'.format(dirname))
     return dirname
 
 
+def mkdirs(basedir, *names):
+    """
+    Like `mkdir()`, but for each of *names* in *basedir*.
+
+    A single `os.scandir()` of *basedir* finds the directories that already
+    exist, so `os.mkdir()` and `os.lstat()` are only needed for the rest.
+    """
+    existing = set(
+        entry.name for entry in os.scandir(basedir)
+        if entry.is_dir(follow_symlinks=False)
+    )
+    return tuple(
+        (path.join(basedir, name) if name in existing else mkdir(basedir, name))
+        for name in names
+    )
+
+
+def write_file(filename, text):
+    """
+    Atomically replace *filename* with *text*.
+
+    The data is written straight to a raw file descriptor on a temporary file,
+    which is then renamed over *filename*, so a reader (like CouchDB) never
+    sees a half written file.
+
+    The file is only readable by the current user, as session.ini contains the
+    admin password hash and the OAuth secrets.
+    """
+    data = text.encode('utf-8')
+    tmp = filename + '.tmp'
+    # A stale temporary file would keep its old mode, so remove it first:
+    try:
+        os.unlink(tmp)
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        # os.write() can write less than asked, so loop until it's all out:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+    finally:
+        os.close(fd)
+    os.replace(tmp, filename)
+
+
 def logfile(logdir, name):
     filename = path.join(logdir, name + '.log')
-    if path.isfile(filename):
-        os.rename(filename, filename + '.previous')
+    try:
+        os.replace(filename, filename + '.previous')
+    except FileNotFoundError:
+        pass
     return filename
 
 
-class Paths:
+_Paths = namedtuple('Paths', 'ini vm_args databases views dump ssl log logfile')
+
+
+class Paths(_Paths):
     """
     Just a namespace for the various files and directories in *basedir*.
     """
 
-    __slots__ = (
-        'ini',
-        'vm_args',
-        'databases',
-        'views',
-        'dump',
-        'ssl',
-        'log',
-        'logfile',
-    )
+    __slots__ = ()
 
-    def __init__(self, basedir):
-        self.ini = path.join(basedir, 'session.ini')
-        self.vm_args = path.join(basedir, 'vm.args')
-        self.databases = mkdir(basedir, 'databases')
-        self.views = mkdir(basedir, 'views')
-        self.dump = mkdir(basedir, 'dump')
-        self.ssl = mkdir(basedir, 'ssl')
-        self.log = mkdir(basedir, 'log')
-        self.logfile = logfile(self.log, 'couchdb')
+    def __new__(cls, basedir):
+        (databases, views, dump, ssl, log) = mkdirs(basedir,
+            'databases', 'views', 'dump', 'ssl', 'log'
+        )
+        return super().__new__(cls,
+            path.join(basedir, 'session.ini'),
+            path.join(basedir, 'vm.args'),
+            databases,
+            views,
+            dump,
+            ssl,
+            log,
+            logfile(log, 'couchdb'),
+        )
+
+    def __reduce__(self):
+        # Rebuild from the field values (for copy and pickle) rather than
+        # calling __new__() again, which would create directories and rotate
+        # the log file:
+        return (self.__class__._make, (tuple(self),))
 
 
 
@@ -733,13 +905,22 @@ class HTTPError(Exception):
         )
 
 
+def _on_connect(conn):
+    # Our requests are small and latency bound, so don't wait on Nagle:
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return True
+
+
 def basic_auth_header(basic):
     return {'authorization': _basic_authorization(basic)}
 
 
 def get_headers(env):
     headers = {'accept': 'application/json'}
-    if 'basic' in env:
+    if 'authorization' in env:
+        # Already built by build_env(), no need to base64 encode it again:
+        headers['authorization'] = env['authorization']
+    elif 'basic' in env:
         headers.update(basic_auth_header(env['basic']))
     return headers
 
@@ -760,12 +941,16 @@ class LockError(Exception):
 class UserCouch:
     def __init__(self, basedir):
         self.couchdb = None
+        self._conn = None
         self.basedir = path.abspath(basedir)
-        if not path.isdir(self.basedir):
+        # Opening the lockfile fails anyway if basedir isn't a directory, so
+        # no need for a separate path.isdir() stat first:
+        try:
+            self.lockfile = open(path.join(self.basedir, 'lockfile'), 'wb')
+        except (FileNotFoundError, NotADirectoryError):
             raise ValueError('{}.basedir not a directory: {!r}'.format(
                 self.__class__.__name__, self.basedir)
-            )
-        self.lockfile = open(path.join(self.basedir, 'lockfile'), 'wb')
+            ) from None
         try:
             fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
         except IOError:
@@ -799,13 +984,15 @@ class UserCouch:
         session_ini = build_session_ini(version, auth, kw)
         if extra:
             session_ini += extra
-        open(self.paths.ini, 'w').write(session_ini)
+        write_file(self.paths.ini, session_ini)
         if couch_version.couchdb2:
-            open(self.paths.vm_args, 'w').write(build_vm_args(kw))
+            write_file(self.paths.vm_args, build_vm_args(kw))
         address = (env['chttpd_address'] if 'chttpd_address' in env else env['address'])
         self._client = Client(address,
             host=None,
             authorization=env.get('authorization'),
+            timeout=REQUEST_TIMEOUT,
+            on_connect=_on_connect,
         )
         self._client.set_base_header('accept', 'application/json')
         socks.close()
@@ -821,19 +1008,23 @@ class UserCouch:
         if self.couchdb is not None:
             return False
         self.couchdb = start_couchdb(self.paths)
-        # We give CouchDB ~17 seconds to start:
-        t = 0.1
-        for i in range(10):
-            t *= 1.5
-            time.sleep(t)
-            if self.isalive():
+        deadline = time.monotonic() + START_TIMEOUT
+        interval = PROBE_INTERVAL
+        while time.monotonic() < deadline:
+            if probe_address(self._client.address) and self.isalive():
                 if couch_version.couchdb2:
                     self._raw_request('PUT', '/_users')
                     self._raw_request('PUT', '/_replicator')
                 return True
+            if wait_for_exit(self.couchdb, interval):
+                break
+            interval = min(interval * 1.5, MAX_PROBE_INTERVAL)
         raise Exception('could not start CouchDB')
 
     def kill(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
         if self.couchdb is None:
             return False
         self.couchdb.terminate()
@@ -842,12 +1033,22 @@ class UserCouch:
         return True
 
     def _raw_request(self, method, path):
+        # Reuse the keep-alive connection when we have one, but CouchDB may have
+        # closed it while idle, in which case we retry once on a new connection:
+        conn = self._conn
+        if conn is not None and not conn.closed:
+            try:
+                return self._conn_request(conn, method, path)
+            except ConnectionError:
+                pass
+        self._conn = None
         conn = self._client.connect()
-        try:
-            response = conn.request(method, path, {}, None)
-            data = (response.body.read() if response.body else b'')
-        finally:
-            conn.close()   
+        self._conn = conn
+        return self._conn_request(conn, method, path)
+
+    def _conn_request(self, conn, method, path):
+        response = conn.request(method, path, {}, None)
+        data = (response.body.read() if response.body else b'')
         return (response, data)
 
     def _request(self, method, path):
@@ -864,12 +1065,23 @@ class UserCouch:
             )
         try:
             (response, data) = self._request('GET', '/')
-            self._welcome = json.loads(data.decode('utf-8'))
-            self._version = self._welcome.get('version')
+            self.__welcome_data = data
+            self.__welcome = None
             return True
         except OSError:
             return False
 
+    @property
+    def _welcome(self):
+        # The welcome JSON is only decoded when actually needed:
+        if self.__welcome is None:
+            self.__welcome = json.loads(self.__welcome_data.decode('utf-8'))
+        return self.__welcome
+
+    @property
+    def _version(self):
+        return self._welcome.get('version')
+
     def check(self):
         if not self.__bootstraped:
             raise Exception(
@@ -24,10 +24,10 @@
 """
 
 from unittest import TestCase
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 import shutil
 import os
-from os import path
 
 from dbase32 import random_id
 
@@ -39,13 +39,25 @@ class TempPKI(PKI):
     def __init__(self, client_pki=False):
         ssldir = tempfile.mkdtemp(prefix='TempPKI.')
         super().__init__(ssldir)
-        self.create_server_pki(random_id(), random_id())
         if client_pki:
-            self.create_client_pki(random_id(), random_id())
+            # The server and client PKIs are independent, and the real work
+            # happens in openssl subprocesses, so build both concurrently:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    executor.submit(self.create_server_pki,
+                        random_id(), random_id()
+                    ),
+                    executor.submit(self.create_client_pki,
+                        random_id(), random_id()
+                    ),
+                ]
+                for future in futures:
+                    future.result()
+        else:
+            self.create_server_pki(random_id(), random_id())
 
     def __del__(self):
-        if path.isdir(self.ssldir):
-            shutil.rmtree(self.ssldir)
+        shutil.rmtree(self.ssldir, ignore_errors=True)
 
 
 class TempCouch(UserCouch):
@@ -56,23 +68,49 @@ class TempCouch(UserCouch):
 
     def __del__(self):
         super().__del__()
-        if path.isdir(self.basedir):
-            shutil.rmtree(self.basedir)
+        shutil.rmtree(self.basedir, ignore_errors=True)
+
+
+def _skip_couch_test_cases():
+    return os.environ.get('SKIP_USERCOUCH_TEST_CASES') == 'true'
 
 
 class CouchTestCase(TestCase):
     auth = 'basic'
     bind_address = '127.0.0.1'
+    shared_couch = False
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if cls.shared_couch and not _skip_couch_test_cases():
+            # tearDownClass() isn't called if this raises, so only keep the
+            # TempCouch on the class once bootstrap() succeeds:
+            tmpcouch = TempCouch()
+            env = tmpcouch.bootstrap(cls.auth,
+                {'bind_address': cls.bind_address}
+            )
+            cls.tmpcouch = tmpcouch
+            cls.env = env
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.shared_couch:
+            cls.tmpcouch = None
+            cls.env = None
+        super().tearDownClass()
 
     def setUp(self):
-        if os.environ.get('SKIP_USERCOUCH_TEST_CASES') == 'true':
+        if _skip_couch_test_cases():
             self.skipTest('SKIP_USERCOUCH_TEST_CASES=true')
-        self.tmpcouch = TempCouch()
-        self.env = self.tmpcouch.bootstrap(self.auth,
-            {'bind_address': self.bind_address}
-        )
+        if not self.shared_couch:
+            self.tmpcouch = TempCouch()
+            self.env = self.tmpcouch.bootstrap(self.auth,
+                {'bind_address': self.bind_address}
+            )
 
     def tearDown(self):
-        self.tmpcouch = None
-        self.env = None
+        if not self.shared_couch:
+            self.tmpcouch = None
+            self.env = None
 
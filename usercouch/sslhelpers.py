@@ -24,6 +24,7 @@ Helpers for non-interactive creation of SSL certs.
 """
 
 from subprocess import check_call, check_output
+import os
 from os import path
 
 
@@ -69,19 +70,69 @@ def gen_csr(key_file, subject, dst_file):
     ])
 
 
-def gen_cert(csr_file, ca_file, key_file, srl_file, dst_file):
+def gen_key_and_ca(key_file, subject, dst_file, bits=2048):
+    """
+    Create an RSA keypair and a self-signed X509 CA with a single openssl call.
+
+    Same result as `gen_key()` followed by `gen_ca()`, but only spawns one
+    openssl process.
+    """
+    check_call(['openssl', 'req',
+        '-new',
+        '-x509',
+        '-newkey', 'rsa:{}'.format(bits),
+        '-nodes',
+        '-days', '3650',
+        '-keyout', key_file,
+        '-subj', subject,
+        '-out', dst_file,
+    ])
+
+
+def gen_key_and_csr(key_file, subject, dst_file, bits=2048):
+    """
+    Create an RSA keypair and a certificate signing request with one call.
+
+    Same result as `gen_key()` followed by `gen_csr()`, but only spawns one
+    openssl process.
+    """
+    check_call(['openssl', 'req',
+        '-new',
+        '-newkey', 'rsa:{}'.format(bits),
+        '-nodes',
+        '-keyout', key_file,
+        '-subj', subject,
+        '-out', dst_file,
+    ])
+
+
+def random_serial():
+    """
+    Return a random 128-bit certificate serial number as an openssl hex string.
+
+    For example:
+
+    >>> len(random_serial())
+    34
+    """
+    return '0x' + os.urandom(16).hex()
+
+
+def gen_cert(csr_file, ca_file, key_file, dst_file):
     """
     Create a signed certificate from a certificate signing request.
+
+    The certificate gets a `random_serial()`, so no serial file is kept for the
+    CA, and several certificates can be issued by the same CA concurrently.
     """
     check_call(['openssl', 'x509',
         '-req',
         #'-sha384',
         '-days', '3650',
-        '-CAcreateserial',
+        '-set_serial', random_serial(),
         '-in', csr_file,
         '-CA', ca_file,
         '-CAkey', key_file,
-        '-CAserial', srl_file,
         '-out', dst_file
     ])
 
@@ -212,7 +263,6 @@ class CA(Base):
     def __init__(self, ssldir, _id):
         super().__init__(ssldir, _id)
         self.ca_file = path.join(ssldir, _id + '.ca')
-        self.srl_file = path.join(ssldir, _id + '.srl')
 
     def exists(self):
         return path.isfile(self.ca_file)
@@ -222,13 +272,10 @@ class CA(Base):
             raise Exception(
                 'ca_file already exists: {!r}'.format(self.ca_file)
             )
-        gen_key(self.key_file)
-        gen_ca(self.key_file, self.subject, self.ca_file)
+        gen_key_and_ca(self.key_file, self.subject, self.ca_file)
 
     def raw_issue(self, csr_file, dst_file):
-        gen_cert(
-            csr_file, self.ca_file, self.key_file, self.srl_file, dst_file
-        )
+        gen_cert(csr_file, self.ca_file, self.key_file, dst_file)
 
     def issue(self, cert):
         assert isinstance(cert, Cert)
@@ -301,8 +348,7 @@ class Cert(Base):
             raise Exception(
                 'csr_file already exists: {!r}'.format(self.csr_file)
             )
-        gen_key(self.key_file)
-        gen_csr(self.key_file, self.subject, self.csr_file)
+        gen_key_and_csr(self.key_file, self.subject, self.csr_file)
 
     def get_config(self):
         """
@@ -27,16 +27,19 @@ from unittest import TestCase
 import socket
 import os
 from os import path
+import stat
 import io
 import tempfile
 import shutil
 import subprocess
-from copy import deepcopy
+import resource
+from copy import copy, deepcopy
+import pickle
 import json
 
 from random import SystemRandom
 
-from dbase32 import random_id, isdb32
+from dbase32 import random_id, isdb32, DB32ALPHABET
 from degu.client import Client
 
 from usercouch import sslhelpers
@@ -110,6 +113,15 @@ class TestConstants(TestCase):
         self.assertTrue(r >= 0)
         self.assertEqual(str(r), rev)
 
+    def test_file_compression(self):
+        self.assertIsInstance(usercouch.FILE_COMPRESSION, tuple)
+        self.assertEqual(usercouch.FILE_COMPRESSION[0], 'none')
+        self.assertEqual(usercouch.FILE_COMPRESSION[-1], 'snappy')
+        self.assertEqual(
+            usercouch._FILE_COMPRESSION_SET,
+            frozenset(usercouch.FILE_COMPRESSION)
+        )
+
     def test_couch_version(self):
         self.assertIs(type(usercouch.couch_version), usercouch.CouchVersion)
         self.assertEqual(usercouch.couch_version.rootdir, '/')
@@ -198,6 +210,21 @@ class TestFunctions(TestCase):
             _get_configs('OPEN', 'OPEN_2', 'BASIC', 'OAUTH')
         )
 
+    def test_random_ids(self):
+        for count in (1, 2, 4):
+            ids = usercouch.random_ids(count)
+            self.assertIsInstance(ids, list)
+            self.assertEqual(len(ids), count)
+            self.assertEqual(len(set(ids)), count)
+            for _id in ids:
+                self.assertIsInstance(_id, str)
+                self.assertEqual(len(_id), 24)
+                self.assertTrue(set(_id).issubset(DB32ALPHABET))
+        for count in (0, 5):
+            with self.assertRaises(ValueError):
+                usercouch.random_ids(count)
+        self.assertNotEqual(usercouch.random_ids(2), usercouch.random_ids(2))
+
     def test_random_oauth(self):
         kw = usercouch.random_oauth()
         self.assertIsInstance(kw, dict)
@@ -353,6 +380,14 @@ class TestFunctions(TestCase):
             "config['ssl']['cert_file'] is required, but missing"
         )
 
+        # A missing required key is reported before any bad file:
+        with self.assertRaises(ValueError) as cm:
+            usercouch.check_ssl_config({'cert_file': nope})
+        self.assertEqual(
+            str(cm.exception),
+            "config['ssl']['key_file'] is required, but missing"
+        )
+
     def test_check_replicator_config(self):
         tmp = TempDir()
         ca_file = tmp.touch('ca.pem')
@@ -580,6 +615,20 @@ class TestFunctions(TestCase):
         self.assertEqual(config['loglevel'], overrides['loglevel'])
         self.assertEqual(config['file_compression'], 'deflate_9')
         self.assertEqual(config['uuid'], overrides['uuid'])
+        self.assertEqual(len(config['username']), 24)
+        self.assertEqual(len(config['password']), 24)
+        self.assertNotEqual(config['username'], config['password'])
+
+        # auth='basic' with only one of username, password provided
+        username = random_id()
+        config = usercouch.build_config('basic', {'username': username})
+        self.assertEqual(config['username'], username)
+        self.assertEqual(len(config['password']), 24)
+        password = random_id()
+        config = usercouch.build_config('basic', {'password': password})
+        self.assertEqual(len(config['username']), 24)
+        self.assertEqual(config['password'], password)
+
         o2 = {
             'bind_address': random_id(),
             'loglevel': random_id(),
@@ -695,6 +744,12 @@ class TestFunctions(TestCase):
             str(cm.exception),
             "invalid bind_address: '192.168.0.2'"
         )
+        with self.assertRaises(ValueError) as cm:
+            usercouch.netloc_template(['127.0.0.1'])
+        self.assertEqual(
+            str(cm.exception),
+            "invalid bind_address: ['127.0.0.1']"
+        )
 
     def test_build_url(self):
         # Test with invalid scheme
@@ -805,6 +860,25 @@ class TestFunctions(TestCase):
             }
         )
 
+        # auth='oauth' with ssl_port:
+        ssl_port = test_port()
+        env = usercouch.build_env('oauth', deepcopy(config),
+            {'port': port, 'ssl_port': ssl_port}
+        )
+        env2 = env.pop('x_env_ssl')
+        self.assertEqual(env2,
+            {
+                'port': ssl_port,
+                'address': ('127.0.0.1', port),
+                'url': 'https://127.0.0.1:{}/'.format(ssl_port),
+                'basic': env['basic'],
+                'authorization': env['authorization'],
+                'oauth': env['oauth'],
+            }
+        )
+        self.assertIsNot(env2['basic'], env['basic'])
+        self.assertIsNot(env2['oauth'], env['oauth'])
+
     def test_build_template_kw(self):
         config = {
             'bind_address': random_id(),
@@ -1313,6 +1387,18 @@ class TestFunctions(TestCase):
         self.assertIs(type(result), str)
         self.assertEqual(result, usercouch.VM_ARGS.format(**kw))
 
+    def test_address_family(self):
+        self.assertEqual(usercouch.address_family('127.0.0.1'), socket.AF_INET)
+        self.assertEqual(usercouch.address_family('0.0.0.0'), socket.AF_INET)
+        self.assertEqual(usercouch.address_family('::1'), socket.AF_INET6)
+        self.assertEqual(usercouch.address_family('::'), socket.AF_INET6)
+        with self.assertRaises(ValueError) as cm:
+            usercouch.address_family('192.168.0.2')
+        self.assertEqual(
+            str(cm.exception),
+            "invalid bind_address: '192.168.0.2'"
+        )
+
     def test_bind_socket(self):
         sock = usercouch.bind_socket('127.0.0.1')
         self.assertIsInstance(sock, socket.socket)
@@ -1350,6 +1436,28 @@ class TestFunctions(TestCase):
             "invalid bind_address: '192.168.0.2'"
         )
 
+        # Test when family is provided:
+        sock = usercouch.bind_socket('::1', socket.AF_INET6)
+        self.assertEqual(sock.family, socket.AF_INET6)
+        self.assertEqual(sock.getsockname()[0], '::1')
+
+    def test_probe_address(self):
+        sock = usercouch.bind_socket('127.0.0.1')
+        address = sock.getsockname()
+        self.assertIs(usercouch.probe_address(address), False)
+        sock.listen(1)
+        self.assertIs(usercouch.probe_address(address), True)
+        sock.close()
+        self.assertIs(usercouch.probe_address(address), False)
+
+        sock = usercouch.bind_socket('::1')
+        address = ('::1', sock.getsockname()[1])
+        self.assertIs(usercouch.probe_address(address), False)
+        sock.listen(1)
+        self.assertIs(usercouch.probe_address(address), True)
+        sock.close()
+        self.assertIs(usercouch.probe_address(address), False)
+
     def test_get_cmd(self):
         tmp = TempDir()
         ini = tmp.join('session.ini')
@@ -1428,6 +1536,41 @@ class TestFunctions(TestCase):
             ]
         )
 
+    def test_wait_for_exit(self):
+        # Without os.pidfd_open() (Python < 3.9), wait_for_exit() sleeps for
+        # the full timeout, so keep the timeouts short:
+        proc = subprocess.Popen(['/bin/true'])
+        self.assertIs(usercouch.wait_for_exit(proc, 0.5), True)
+        self.assertEqual(proc.returncode, 0)
+        self.assertIs(usercouch.wait_for_exit(proc, 0.5), True)
+
+        proc = subprocess.Popen(['/bin/sleep', '5'])
+        self.assertIs(usercouch.wait_for_exit(proc, 0.05), False)
+        self.assertIsNone(proc.returncode)
+        proc.terminate()
+        self.assertIs(usercouch.wait_for_exit(proc, 0.5), True)
+        self.assertEqual(proc.returncode, -15)
+
+    def test_wait_for_exit_high_pidfd(self):
+        # Still works when the pidfd lands above FD_SETSIZE (1024):
+        if not hasattr(os, 'pidfd_open'):
+            self.skipTest('no os.pidfd_open()')
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < 1100:
+            self.skipTest('RLIMIT_NOFILE too low: {}'.format(soft))
+        fds = []
+        try:
+            while not fds or fds[-1] < 1024:
+                fds.append(os.open(os.devnull, os.O_RDONLY))
+            proc = subprocess.Popen(['/bin/sleep', '5'])
+            self.assertIs(usercouch.wait_for_exit(proc, 0.05), False)
+            proc.terminate()
+            self.assertIs(usercouch.wait_for_exit(proc, 5), True)
+            self.assertEqual(proc.returncode, -15)
+        finally:
+            for fd in fds:
+                os.close(fd)
+
 
 class TestCouchVersion(TestCase):
     def test_init(self):
@@ -1492,6 +1635,7 @@ class TestSockets(TestCase):
     def test_init(self):
         socks = usercouch.Sockets('127.0.0.1')
         self.assertEqual(socks.bind_address, '127.0.0.1')
+        self.assertEqual(socks.family, socket.AF_INET)
         self.assertIsInstance(socks.socks, dict)
 
         if usercouch.couch_version.couchdb2:
@@ -1629,6 +1773,78 @@ class TestPathFunctions(TestCase):
             usercouch.mkdir(tmp.dir, 'link')
         self.assertEqual(str(cm.exception), 'not a directory: {!r}'.format(link))
 
+    def test_mkdirs(self):
+        tmp = TempDir()
+
+        # Test when basedir does not exist:
+        basedir = tmp.join('foo')
+        with self.assertRaises(FileNotFoundError):
+            usercouch.mkdirs(basedir, 'bar')
+        self.assertFalse(path.exists(basedir))
+
+        # Test when none exist, then when all exist:
+        expected = (tmp.join('foo'), tmp.join('bar'))
+        self.assertEqual(usercouch.mkdirs(tmp.dir, 'foo', 'bar'), expected)
+        self.assertTrue(path.isdir(tmp.join('foo')))
+        self.assertTrue(path.isdir(tmp.join('bar')))
+        self.assertEqual(usercouch.mkdirs(tmp.dir, 'foo', 'bar'), expected)
+
+        # Test when some exist:
+        self.assertEqual(usercouch.mkdirs(tmp.dir, 'bar', 'baz'),
+            (tmp.join('bar'), tmp.join('baz'))
+        )
+        self.assertTrue(path.isdir(tmp.join('baz')))
+
+        # Test when one exists and is a file:
+        f = tmp.touch('file')
+        with self.assertRaises(ValueError) as cm:
+            usercouch.mkdirs(tmp.dir, 'foo', 'file')
+        self.assertEqual(str(cm.exception), 'not a directory: {!r}'.format(f))
+
+        # Test when one exists and is a symlink to a dir:
+        link = tmp.join('link')
+        os.symlink(tmp.join('foo'), link)
+        with self.assertRaises(ValueError) as cm:
+            usercouch.mkdirs(tmp.dir, 'foo', 'link')
+        self.assertEqual(str(cm.exception), 'not a directory: {!r}'.format(link))
+
+    def test_write_file(self):
+        tmp = TempDir()
+        filename = tmp.join('session.ini')
+        self.assertIsNone(usercouch.write_file(filename, 'hello\n'))
+        with open(filename, 'r') as fp:
+            self.assertEqual(fp.read(), 'hello\n')
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o600)
+
+        # Existing content is replaced:
+        self.assertIsNone(usercouch.write_file(filename, 'bye\n'))
+        with open(filename, 'r') as fp:
+            self.assertEqual(fp.read(), 'bye\n')
+        self.assertEqual(os.listdir(tmp.dir), ['session.ini'])
+
+        # Larger, non-ASCII content:
+        text = 'caf\xe9\n' * 100000
+        self.assertIsNone(usercouch.write_file(filename, text))
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), text.encode('utf-8'))
+
+        # A stale temporary file (say, from a crash) is overwritten, and its
+        # mode isn't carried over:
+        stale = tmp.write(b'junk' * 1000, 'session.ini.tmp')
+        os.chmod(stale, 0o644)
+        self.assertIsNone(usercouch.write_file(filename, 'hello\n'))
+        with open(filename, 'r') as fp:
+            self.assertEqual(fp.read(), 'hello\n')
+        self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o600)
+        self.assertEqual(os.listdir(tmp.dir), ['session.ini'])
+
+        # The file is replaced, not rewritten in place:
+        ino = os.stat(filename).st_ino
+        with open(filename, 'r') as fp:
+            usercouch.write_file(filename, 'bye\n')
+            self.assertEqual(fp.read(), 'hello\n')
+        self.assertNotEqual(os.stat(filename).st_ino, ino)
+
     def test_logfile(self):
         tmp = TempDir()
         self.assertEqual(
@@ -1644,11 +1860,24 @@ class TestPathFunctions(TestCase):
         self.assertTrue(path.isfile(tmp.join('bar.log.previous')))
         self.assertEqual(os.listdir(tmp.dir), ['bar.log.previous'])
 
+        # An older .previous gets replaced:
+        tmp.write(b'newer', 'bar.log')
+        self.assertEqual(
+            usercouch.logfile(tmp.dir, 'bar'),
+            tmp.join('bar.log')
+        )
+        self.assertEqual(os.listdir(tmp.dir), ['bar.log.previous'])
+        with open(tmp.join('bar.log.previous'), 'rb') as fp:
+            self.assertEqual(fp.read(), b'newer')
+
 
 class TestPaths(TestCase):
     def test_init(self):
         tmp = TempDir()
         paths = usercouch.Paths(tmp.dir)
+        self.assertIsInstance(paths, tuple)
+        with self.assertRaises(AttributeError):
+            paths.ini = tmp.join('nope.ini')
         self.assertEqual(paths.ini, tmp.join('session.ini'))
         self.assertEqual(paths.vm_args, tmp.join('vm.args'))
         self.assertEqual(paths.databases, tmp.join('databases'))
@@ -1693,6 +1922,20 @@ class TestPaths(TestCase):
         )
         self.assertTrue(path.isfile(tmp.join('log', 'couchdb.log.previous')))
 
+    def test_copy_and_pickle(self):
+        tmp = TempDir()
+        paths = usercouch.Paths(tmp.dir)
+        tmp.touch('log', 'couchdb.log')
+        for clone in [
+                copy(paths),
+                deepcopy(paths),
+                pickle.loads(pickle.dumps(paths)),
+                pickle.loads(pickle.dumps(paths, protocol=0))]:
+            self.assertIs(type(clone), usercouch.Paths)
+            self.assertEqual(clone, paths)
+        # The log wasn't rotated again by any of the above:
+        self.assertEqual(os.listdir(tmp.join('log')), ['couchdb.log'])
+
 
 class TestHTTPError(TestCase):
     def test_init(self):
@@ -1731,6 +1974,15 @@ class TestHTTPFunctions(TestCase):
             }
         )
 
+        # env['authorization'] from build_env() is used as is:
+        env['authorization'] = 'Basic prebuilt'
+        self.assertEqual(usercouch.get_headers(env),
+            {
+                'accept': 'application/json',
+                'authorization': 'Basic prebuilt',
+            }
+        )
+
 
 class TestLockError(TestCase):
     def test_init(self):
@@ -1840,6 +2092,7 @@ class TestUserCouch(TestCase):
         self.assertEqual(uc._client.base_headers, (
             ('accept', 'application/json'),
         ))
+        self.assertEqual(uc._client.timeout, usercouch.REQUEST_TIMEOUT)
 
         # check env
         self.assertIsInstance(env, dict)
@@ -76,6 +76,15 @@ class TestTempPKI(TestCase):
         self.assertIs(pki.client_cert.ssldir, pki.ssldir)
         self.assertIs(pki.client_cert.ca_id, pki.client_ca.id)
 
+    def test_del(self):
+        pki = misc.TempPKI()
+        self.assertTrue(path.isdir(pki.ssldir))
+        pki.__del__()
+        self.assertFalse(path.exists(pki.ssldir))
+        # Calling again when ssldir is already gone is fine:
+        pki.__del__()
+        self.assertFalse(path.exists(pki.ssldir))
+
 
 class TestTempCouch(TestCase):
     def test_init(self):
@@ -148,3 +157,23 @@ class SelfTest4(CouchTestCase):
         self.assertEqual(set(self.env), expected)
         self.assertTrue(self.env['url'].startswith('http://127.0.0.1:'))
 
+
+class SelfTest5(CouchTestCase):
+    shared_couch = True
+    seen = []
+
+    def check_shared(self):
+        self.assertIsInstance(self.tmpcouch, TempCouch)
+        self.assertIs(self.tmpcouch, self.__class__.tmpcouch)
+        self.assertIs(self.env, self.__class__.env)
+        self.assertTrue(self.tmpcouch.isalive())
+        # Record only the id(), so this doesn't keep the TempCouch alive
+        # after tearDownClass():
+        self.seen.append(id(self.tmpcouch))
+        self.assertEqual(self.seen[0], id(self.tmpcouch))
+
+    def test_first(self):
+        self.check_shared()
+
+    def test_second(self):
+        self.check_shared()
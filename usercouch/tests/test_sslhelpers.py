@@ -26,6 +26,7 @@ Unit tests for the `usercouch.sslhelpers` module.
 from unittest import TestCase
 import os
 from os import path
+from subprocess import check_output
 
 from dbase32 import random_id
 
@@ -33,6 +34,14 @@ from usercouch import sslhelpers
 from . import TempDir
 
 
+def get_serial(cert_file):
+    return check_output(['openssl', 'x509',
+        '-serial',
+        '-noout',
+        '-in', cert_file,
+    ])
+
+
 class TestFunctions(TestCase):
     def test_gen_key(self):
         tmp = TempDir()
@@ -62,6 +71,30 @@ class TestFunctions(TestCase):
         self.assertTrue(path.isfile(csr))
         self.assertGreater(path.getsize(csr), 0)
 
+    def test_gen_key_and_ca(self):
+        tmp = TempDir()
+        key = tmp.join('key.pem')
+        ca = tmp.join('ca.pem')
+        self.assertIsNone(sslhelpers.gen_key_and_ca(key, '/CN=foobar', ca))
+        self.assertGreater(path.getsize(key), 0)
+        self.assertGreater(path.getsize(ca), 0)
+        self.assertEqual(
+            sslhelpers.get_cert_pubkey(ca),
+            sslhelpers.get_pubkey(key)
+        )
+
+    def test_gen_key_and_csr(self):
+        tmp = TempDir()
+        key = tmp.join('key.pem')
+        csr = tmp.join('csr.pem')
+        self.assertIsNone(sslhelpers.gen_key_and_csr(key, '/CN=foobar', csr))
+        self.assertGreater(path.getsize(key), 0)
+        self.assertGreater(path.getsize(csr), 0)
+        self.assertEqual(
+            sslhelpers.get_csr_pubkey(csr),
+            sslhelpers.get_pubkey(key)
+        )
+
     def test_gen_cert(self):
         tmp = TempDir()
 
@@ -78,13 +111,28 @@ class TestFunctions(TestCase):
         sslhelpers.gen_csr(bar_key, '/CN=bar', bar_csr)
 
         # Now sign the csr
-        foo_srl = tmp.join('foo.srl')
         bar_cert = tmp.join('bar.cert')
-        self.assertFalse(path.isfile(foo_srl))
         self.assertFalse(path.isfile(bar_cert))
-        sslhelpers.gen_cert(bar_csr, foo_ca, foo_key, foo_srl, bar_cert)
+        sslhelpers.gen_cert(bar_csr, foo_ca, foo_key, bar_cert)
         self.assertGreater(path.getsize(bar_cert), 0)
-        self.assertGreater(path.getsize(foo_srl), 0)
+
+        # No serial file is left behind:
+        self.assertEqual(sorted(os.listdir(tmp.dir)),
+            ['bar.cert', 'bar.csr', 'bar.key', 'foo.ca', 'foo.key']
+        )
+
+        # Signing the same csr again gets a different serial:
+        baz_cert = tmp.join('baz.cert')
+        sslhelpers.gen_cert(bar_csr, foo_ca, foo_key, baz_cert)
+        self.assertNotEqual(get_serial(bar_cert), get_serial(baz_cert))
+
+    def test_random_serial(self):
+        serial = sslhelpers.random_serial()
+        self.assertIsInstance(serial, str)
+        self.assertEqual(len(serial), 34)
+        self.assertTrue(serial.startswith('0x'))
+        self.assertLessEqual(int(serial, 16).bit_length(), 128)
+        self.assertNotEqual(sslhelpers.random_serial(), serial)
 
     def test_get_pubkey(self):
         tmp = TempDir()
@@ -92,7 +140,6 @@ class TestFunctions(TestCase):
         # Create CA
         foo_key = tmp.join('foo.key')
         foo_ca = tmp.join('foo.ca')
-        foo_srl = tmp.join('foo.srl')
         sslhelpers.gen_key(foo_key)
         foo_pubkey = sslhelpers.get_pubkey(foo_key)
         sslhelpers.gen_ca(foo_key, '/CN=foo', foo_ca)
@@ -104,7 +151,7 @@ class TestFunctions(TestCase):
         sslhelpers.gen_key(bar_key)
         bar_pubkey = sslhelpers.get_pubkey(bar_key)
         sslhelpers.gen_csr(bar_key, '/CN=bar', bar_csr)
-        sslhelpers.gen_cert(bar_csr, foo_ca, foo_key, foo_srl, bar_cert)
+        sslhelpers.gen_cert(bar_csr, foo_ca, foo_key, bar_cert)
 
         # Now compare
         os.remove(foo_key)
@@ -521,7 +568,6 @@ class TestCA(TestCase):
         self.assertEqual(ca.subject, '/CN=' + ca_id)
         self.assertEqual(ca.key_file, tmp.join(ca_id + '.key'))
         self.assertEqual(ca.ca_file, tmp.join(ca_id + '.ca'))
-        self.assertEqual(ca.srl_file, tmp.join(ca_id + '.srl'))
 
     def test_repr(self):
         ca = sslhelpers.CA('/some/dir', 'foo')
@@ -633,7 +679,6 @@ class TestFlatCert(TestCase):
         self.assertEqual(cert.subject, '/CN=' + _id)
         self.assertEqual(cert.key_file, tmp.join(_id + '.key'))
         self.assertEqual(cert.ca_file, tmp.join(_id + '.ca'))
-        self.assertEqual(cert.srl_file, tmp.join(_id + '.srl'))
         self.assertIs(cert.cert_file, cert.ca_file)
 
     def test_get_server_config(self):